@@ -1,13 +1,18 @@
 #!/usr/bin/env python
 
 import re
+import json
 import click
+from pybtex.database import BibliographyData
 
-from recibi.matching import string_match, number_match
-from recibi.bib import load, dump, sort, trans, merge_patch
+from recibi.matching import filter_match, search_match
+from recibi.bib import load, dump, sort, trans, merge_patch, tagger, select, rekey, stream, parse_text
 import recibi.inspire as inspire_api
 import recibi.osti as osti_api
 from recibi import apis
+from recibi import db as db_api
+from recibi import bench as bench_api
+from recibi import watch as watch_api
 import logging
 logging.basicConfig(filename='/dev/stderr', level=logging.INFO)
 logger = logging.getLogger("recibi")
@@ -69,6 +74,21 @@ def csv(delim, columns, skip, kind, output, textfiles):
     dump(sort(trans(textfiles, columns, kind, delim, skip)), output)
 
 
+@cli.command("rekey")
+@click.option("-o", "--output", default="/dev/stdout",
+              help="Output file")
+@click.argument('bibfiles', nargs=-1, type=click.Path())
+def cmd_rekey(output, bibfiles):
+    '''
+    Replace entry keys with generated keys as used by "recibi csv".
+
+    Entries that would get the same key are given a numerical suffix.
+
+    Input file may be "-" to indicate stdin.
+    '''
+    dump(sort(rekey(load(bibfiles))), output)
+
+
 @cli.command("merge")
 @click.option("-o", "--output", default="/dev/stdout",
               help="Output file")
@@ -87,8 +107,10 @@ def merge(output, bibfiles):
               help="Match fields with <field>:<re>, multiple act as AND")
 @click.option("-n", "--number", default=[], multiple=True,
               help="Match fields with <field>:<test>, multiple act as AND")
+@click.option("-j", "--jobs", default=1,
+              help="Number of worker processes to match entries")
 @click.argument('bibfiles', nargs=-1, type=click.Path())
-def filter(output, match, number, bibfiles):
+def filter(output, match, number, jobs, bibfiles):
     '''
     Output matching records.
 
@@ -106,15 +128,22 @@ def filter(output, match, number, bibfiles):
         -m collaboration:dune -n year:>2018
 
     Input file may be "-" to indicate stdin.
+
+    With -j/--jobs greater than one, input text is split between parallel
+    worker processes which parse and match entries.  Output order is
+    unchanged.
     '''
 
     matches = tuple([m.split(":", 1) for m in match])
     numbers = tuple([n.split(":", 1) for n in number])
 
+    if jobs > 1:
+        bib = select(bibfiles, filter_match, (matches, numbers), jobs)
+        dump(bib, output)
+        return
+
     def do_filt(key, entry):
-        if not number_match(key, entry, numbers):
-            return
-        if not string_match(key, entry, matches):
+        if not filter_match(key, entry, matches, numbers):
             return
         return key, entry
 
@@ -135,34 +164,7 @@ def tag(output, tag, transfer, bibfiles):
 
     An input file name of "-" is interpreted to be stdin.
     '''
-    tags = ','.join(tag)
-
-    def squash(val):
-        return val.lower().replace(" ", "").replace("-", "")
-
-    def add_tag(key, entry):
-        old = entry.fields.get("keywords", None)
-        if not old:
-            new = tags
-        else:
-            new = old + "," + tags
-
-        # make unique and sorted
-        new = set(new.split(','))
-
-        for field in transfer:
-            val = entry.fields.get(field, None)
-            if val is None:
-                continue
-            new.add(squash(val))
-        new = list([n for n in new if n])
-        new.sort()
-        new = ','.join(new)
-        entry.fields['keywords'] = new
-
-        return (key, entry)
-
-    dump(load(bibfiles, mutate=add_tag), output)
+    dump(load(bibfiles, mutate=tagger(tag, transfer)), output)
 
 
 @cli.command("osti")
@@ -171,8 +173,17 @@ def tag(output, tag, transfer, bibfiles):
 @click.option("-F", "--format", default="bibtex",
               type=click.Choice(["bibtex", "json", "xml"]),
               help="Set the format for the output")
+@click.option("-b", "--bulk", type=click.Path(), multiple=True,
+              help="Give a file with query terms, one per line, "
+              "each retrieved as a separate query")
+@click.option("-j", "--jobs", default=4,
+              help="Number of concurrent queries in bulk mode")
+@click.option("-r", "--rows", default=None, type=int,
+              help="Number of records per page in bulk mode")
+@click.option("--as-bib", is_flag=True, default=False,
+              help="In bulk mode, retrieve JSON and convert to BibTeX")
 @click.argument("query", nargs=-1)
-def cmd_osti(output, format, query):
+def cmd_osti(output, format, bulk, jobs, rows, as_bib, query):
     '''
     Query DOE OSTI API endpoint /records.
 
@@ -185,24 +196,65 @@ def cmd_osti(output, format, query):
         <param>=<value>
         <idtype>:<idvalue>
         <osti_id_number>
+        <doi>
 
     The supported <idtype> is either doi or osti_id.
+
+    In bulk mode, each term from the -b/--bulk files is queried separately
+    and all pages of results are followed.  Pages are written as they arrive.
+    JSON is written as JSON Lines with one record per line.
+    A bulk file of "-" reads stdin.  Bare DOIs (eg 10.1000/abc) are accepted.
+    With --as-bib, records are converted to BibTeX entries with keys
+    "OSTI:<osti_id>" and records repeated across pages or terms are written
+    once.
     '''
+    if bulk:
+        terms = list(query)
+        for one in bulk:
+            if one == "-":
+                one = "/dev/stdin"
+            for line in open(one):
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                terms.append(line)
+
+        if as_bib:
+            format = "json"
+
+        seen = set()
+        with open(output, "w") as out:
+            def emit(text):
+                if as_bib:
+                    bib = BibliographyData()
+                    for key, entry in osti_api.json_entries(text):
+                        # as bib.stream(), skip keys already written
+                        if key.lower() in seen:
+                            debug(f'skipping repeated key "{key}"')
+                            continue
+                        seen.add(key.lower())
+                        bib.add_entry(key, entry)
+                    if not bib.entries:
+                        return
+                    text = bib.to_string("bibtex")
+                elif format == "json":
+                    records = json.loads(text)
+                    if isinstance(records, dict):
+                        records = [records]
+                    text = "\n".join(json.dumps(rec) for rec in records)
+                    if not text:
+                        return
+                out.write(text + "\n")
+                out.flush()
+            nfail, nquery = osti_api.bulk(terms, emit, format, jobs, rows)
+        if nfail:
+            warn(f'{nfail} of {nquery} queries failed')
+        return
+
     queries = dict()
     for q in query:
-        if '=' in q:
-            q = q.split('=', 1)
-        elif ':' in q:
-            q = q.split(':', 1)
-        if isinstance(q, str):
-            queries['osti_id'] = q
-            continue
-        key = q[0].lower()
-        val = q[1]
-        if key == 'osti':
-            key = 'osti_id'
-        if key == 'arxiv':
-            warn(f'OSTI API does not support arXiv IDs, skipping {val}')
+        q = osti_api.parse_term(q)
+        if q is None:
             continue
         queries[q[0]] = q[1]
 
@@ -236,9 +288,20 @@ def cmd_osti(output, format, query):
               "args to the q= search queries")
 @click.option("--maxn", default=10,
               help="Max number of search queries per GET")
+@click.option("-A", "--all-pages", is_flag=True, default=False,
+              help="Retrieve all pages of search results starting at --page")
+@click.option("-t", "--tag", multiple=True,
+              help="A value to add to the 'keywords' field of bibtex results")
+@click.option("-m", "--match", default=[], multiple=True,
+              help="Keep bibtex results matching <field>:<re>, multiple act as AND")
+@click.option("-n", "--number", default=[], multiple=True,
+              help="Keep bibtex results matching <field>:<test>, multiple act as AND")
+@click.option("--merge", is_flag=True, default=False,
+              help="Merge bibtex results with repeated keys and sort, "
+              "output is written at the end")
 @click.argument("query", nargs=-1)
 def inspire(output, type, value, format, queries, sort, size, page,
-            query_join, maxn, query):
+            query_join, maxn, all_pages, tag, match, number, merge, query):
     '''
     Access InspireHEP web API.
 
@@ -254,9 +317,16 @@ def inspire(output, type, value, format, queries, sort, size, page,
     Default format is bibtex however some identifier-types will return JSON
     regardless.
 
-    Pagination is not supported.
+    With -A/--all-pages, pages are retrieved until exhausted.
 
-    Take in mind InspireHEP has a rate limit.  This command will make 1 query.
+    Results are written as each page is received while the next page is
+    retrieved.  If any of -t, -m, -n or --merge are given, bibtex results
+    are parsed as each page arrives, tagged and filtered as with "recibi
+    tag" and "recibi filter", and written.  Entries with a key already
+    written are skipped unless --merge is given.
+
+    Take in mind InspireHEP has a rate limit.  This command makes 1 query per
+    --maxn query terms per page.
     '''
     query = list(query)
     queries = list(queries)
@@ -279,50 +349,255 @@ def inspire(output, type, value, format, queries, sort, size, page,
     query = list(set(query))
     query.sort()
 
-    chunks = list()
-    for group in [query[x:x+maxn] for x in range(0, len(query), maxn)]:
-        params = inspire_api.form_params(
-            q=group, sort=sort, size=str(size), page=str(page), format=format)
-        url = inspire_api.form_url(type, value, params)
-        text = apis.get(url)
-        chunks.append(text)
+    def fetched():
+        for group in [query[x:x+maxn] for x in range(0, len(query), maxn)]:
+            yield from inspire_api.pages(
+                type, value, all_pages, page, size, f" {query_join} ",
+                q=group, sort=sort, format=format)
+
+    def texts():
+        # retrieve the next page while one is written
+        return apis.prefetch(fetched())
+
+    if format != "bibtex" or not (tag or match or number or merge):
+        with open(output, "w") as out:
+            for text in texts():
+                out.write(text + "\n")
+                out.flush()
+        return
+
+    matches = tuple(m.split(":", 1) for m in match)
+    numbers = tuple(n.split(":", 1) for n in number)
+    tagit = tagger(tag) if tag else None
+
+    def mutate(key, entry):
+        if not filter_match(key, entry, matches, numbers):
+            return
+        if tagit:
+            return tagit(key, entry)
+        return (key, entry)
 
-    with open(output, "w") as out:
-        out.write('\n'.join(chunks))
+    def bibs():
+        for text in texts():
+            if text.lstrip().startswith(("{", "[")):
+                raise click.ClickException(
+                    f'InspireHEP returned JSON for identifier type "{type}" '
+                    'which can not be tagged, filtered or merged')
+            yield parse_text(text)
+
+    stream(bibs(), output, mutate=mutate,
+           merge=merge_patch if merge else None)
 
 @cli.command("search")
 @click.option("-o", "--output", default="/dev/stdout",
               help='Output file')
 @click.option("-s", "--search", multiple=True,
               help="Search terms like field=regex")
+@click.option("-j", "--jobs", default=1,
+              help="Number of worker processes to match entries")
 @click.argument("bibfiles", nargs=-1)
-def search(output, search, bibfiles):
+def search(output, search, jobs, bibfiles):
     '''
     Search a bib file for matching entries.
 
     Search terms are in form 'field:regex' where the special field "key" may be
     used to match the entry key.  All search terms given must match for an entry
     to be emitted.
+
+    With -j/--jobs greater than one, input text is split between parallel
+    worker processes which parse and match entries.  Output order is
+    unchanged.
     '''
     terms = [(field, re.compile(regex, re.IGNORECASE))
              for field, regex in map(lambda s: s.split("=", 1), search)]
 
-    def findit(key, entry):
-
-        # must run the gauntlet 
-        for field, regex in terms:
-            if field == 'key':
-                if re.match(regex, key):
-                    continue
-            elif field in entry.fields:
-                if re.search(regex, entry.fields[field]):
-                    continue
-            return              # entry has no field
+    if jobs > 1:
+        dump(select(bibfiles, search_match, (terms,), jobs), output)
+        return
 
+    def findit(key, entry):
+        # must run the gauntlet
+        if not search_match(key, entry, terms):
+            return
         return (key, entry)
     dump(load(bibfiles, mutate=findit), output)
 
 
+@cli.group("db")
+def db():
+    '''
+    Operate on a SQLite bibliography database.
+    '''
+    pass
+
+
+database_option = click.option(
+    "-d", "--database", default="recibi.db", type=click.Path(),
+    help="The SQLite database file")
+
+
+@db.command("import")
+@database_option
+@click.option("--merge/--no-merge", default=True,
+              help="Merge entries with existing keys, else replace them")
+@click.argument('bibfiles', nargs=-1, type=click.Path())
+def db_import(database, merge, bibfiles):
+    '''
+    Import bibliography files into the database.
+
+    Input file may be "-" to indicate stdin.
+
+    Files are stored one at a time so only one file is held in memory.
+    '''
+    merger = merge_patch if merge else None
+    conn = db_api.connect(database)
+    for bibfile in bibfiles or ["-"]:
+        db_api.store(conn, load([bibfile], merge=merger), merge=merger)
+
+
+@db.command("dump")
+@database_option
+@click.option("-o", "--output", default="/dev/stdout",
+              help="Output file")
+@click.option("-k", "--key", default=[], multiple=True,
+              help="Dump only entries with the given key(s)")
+def db_dump(database, output, key):
+    '''
+    Export entries from the database.
+    '''
+    conn = db_api.connect(database)
+    if key:
+        bib = db_api.select_keys(conn, sorted(set(key)))
+    else:
+        bib = db_api.select(conn)
+    dump(bib, output)
+
+
+@db.command("search")
+@database_option
+@click.option("-o", "--output", default="/dev/stdout",
+              help='Output file')
+@click.option("-s", "--search", multiple=True,
+              help="Search terms like field=regex")
+@click.option("-f", "--fts", default=None,
+              help="A full-text query over title, abstract and author")
+def db_search(database, output, search, fts):
+    '''
+    Search the database for matching entries.
+
+    Search terms are as for "recibi search".  The full-text query uses SQLite
+    FTS5 syntax, eg:
+
+        -f 'neutrino NEAR(proton decay)'
+    '''
+    terms = tuple(s.split("=", 1) for s in search)
+    conn = db_api.connect(database)
+    dump(db_api.select(conn, terms=terms, fts=fts), output)
+
+
+@db.command("filter")
+@database_option
+@click.option("-o", "--output", default="/dev/stdout",
+              help="Output file")
+@click.option("-m", "--match", default=[], multiple=True,
+              help="Match fields with <field>:<re>, multiple act as AND")
+@click.option("-n", "--number", default=[], multiple=True,
+              help="Match fields with <field>:<test>, multiple act as AND")
+def db_filter(database, output, match, number):
+    '''
+    Output matching records from the database.
+
+    Matches are as for "recibi filter" except numerical tests are limited to
+    a comparison operator and a number, eg:
+
+        -m collaboration:dune -n year:>2018
+    '''
+    matches = tuple(m.split(":", 1) for m in match)
+    numbers = tuple(n.split(":", 1) for n in number)
+    for field, test in numbers:
+        try:
+            db_api.number_test(test)
+        except ValueError as err:
+            raise click.BadParameter(str(err), param_hint="-n/--number")
+    conn = db_api.connect(database)
+    dump(db_api.select(conn, matches=matches, numbers=numbers), output)
+
+
+@db.command("tag")
+@database_option
+@click.option("-t", "--tag", multiple=True,
+              help="A value to add to the 'keywords' field")
+@click.option("-T", "--transfer", multiple=True,
+              help="Transfer given field to a keyword")
+@click.option("-s", "--search", multiple=True,
+              help="Only tag entries matching search terms like field=regex")
+def db_tag(database, tag, transfer, search):
+    '''
+    Add tag(s) to the "keywords" field of entries in the database.
+    '''
+    terms = tuple(s.split("=", 1) for s in search)
+    conn = db_api.connect(database)
+    n = db_api.update(conn, tagger(tag, transfer), terms=terms)
+    info(f'tagged {n} entries')
+
+
+@cli.command("bench")
+@click.option("-o", "--output", default="/dev/stdout",
+              help="Output file for JSON records")
+@click.option("-n", "--number", default=[1000, 10000], multiple=True,
+              type=int, help="Number of entries in a synthetic corpus")
+@click.option("-b", "--budget", default=None, type=click.Path(),
+              help="A JSON file giving per-stage limits")
+@click.option("--max-slowdown", default=None, type=float,
+              help="Max growth in time per entry from smallest to largest corpus")
+@click.option("--trace/--no-trace", default=True,
+              help="Also measure allocations with tracemalloc")
+def cmd_bench(output, number, budget, max_slowdown, trace):
+    '''
+    Measure load, merge, sort and dump on synthetic corpora.
+
+    For each stage and corpus size, records are output as JSON with time,
+    entries per second, tracemalloc allocations and the peak and growth of
+    RSS, measured per stage in a forked child.  The command fails if any
+    budget is exceeded.  A budget file looks like:
+
+        {"*": {"max_rss_kb": 500000, "max_stage_rss_kb": 100000},
+         "merge": {"min_rate": 2000, "max_alloc_peak": 100000000}}
+    '''
+    if budget:
+        budget = bench_api.load_budget(budget)
+    records, bad = bench_api.bench(number, budget, max_slowdown, trace)
+    with open(output, "w") as out:
+        out.write(json.dumps(dict(records=records, violations=bad), indent=2))
+        out.write("\n")
+    if bad:
+        raise click.ClickException("budget exceeded:\n" + "\n".join(bad))
+
+
+@cli.command("watch")
+@click.option("-i", "--interval", default=0.5,
+              help="Seconds between checks for changed inputs")
+@click.option("--once", is_flag=True, default=False,
+              help="Build outputs once and exit")
+@click.argument("rulefile", type=click.Path(exists=True))
+def cmd_watch(interval, once, rulefile):
+    '''
+    Rebuild derived bib files as their inputs change.
+
+    The RULEFILE is JSON listing rules, each with an "output", its "inputs"
+    and optional "match", "number", "search", "tag" and "transfer" lists
+    taking values as the options of the filter, search and tag commands.
+    Inputs of a rule are merged as with the merge command.  Example:
+
+        {"rules": [{"output": "dune.bib", "inputs": ["all.bib"],
+                    "match": ["collaboration:dune"], "tag": ["dune"]}]}
+
+    Only entries added, changed or removed in an input are reprocessed and
+    outputs are replaced atomically.
+    '''
+    watch_api.watch(watch_api.load_rules(rulefile), interval, once)
+
+
 def main():
     cli()
 
@@ -3,7 +3,9 @@
 General utility functions for accessing web APIs.
 '''
 
-
+import re
+import queue
+import threading
 from urllib.error import HTTPError
 from urllib.request import Request, urlopen
 
@@ -33,15 +35,15 @@ def form_params(joiner=",", **params):
     return "&".join(parts)
 
 
-def get(url, **headers):
+def fetch(url, **headers):
     '''
-    Perform HTTP GET on url and return text.
+    Perform HTTP GET on url and return (text, response headers).
     '''
 
     req = Request(url)
     for key, val in headers.items():
         req.add_header(key, val)
-        print(f'Header: {key} {val}')
+        debug(f'Header: {key} {val}')
 
     debug(req)
 
@@ -51,5 +53,84 @@ def get(url, **headers):
         warn(f'bad URL: {url}. {err}')
         raise
     if res.getcode() == 200:
-        return res.read().decode()
+        return res.read().decode(), res.headers
     raise IOError(f'HTTP GET error {res.getcode()} for {url}')
+
+
+def get(url, **headers):
+    '''
+    Perform HTTP GET on url and return text.
+    '''
+    return fetch(url, **headers)[0]
+
+
+def parse_links(value):
+    '''
+    Parse an RFC 8288 "Link" header value into a dict from rel to URL.
+    '''
+    links = dict()
+    if not value:
+        return links
+    for url, params in re.findall(r'<([^>]*)>([^,<]*)', value):
+        m = re.search(r'rel\s*=\s*"?([^";]+)"?', params)
+        if m:
+            for rel in m.group(1).split():
+                links[rel] = url
+    return links
+
+
+def get_pages(url, **headers):
+    '''
+    Generate text of each page starting at url.
+
+    Pages are followed through the rel="next" URL in the "Link" response
+    header.
+    '''
+    seen = set()
+    while url and url not in seen:
+        seen.add(url)
+        text, resh = fetch(url, **headers)
+        yield text
+        url = parse_links(resh.get("Link")).get("next")
+
+
+def prefetch(items):
+    '''
+    Generate from the iterable items while a thread gets the next one.
+
+    This lets a page be downloaded while the previous one is processed.  At
+    most one item waits to be taken.  An error from items is raised here.
+    '''
+    got = queue.Queue(maxsize=1)
+    stop = threading.Event()
+    done = object()
+
+    def put(one):
+        while not stop.is_set():
+            try:
+                got.put(one, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def work():
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except BaseException as err:
+            put((done, err))
+
+    threading.Thread(target=work, daemon=True).start()
+    try:
+        while True:
+            item, err = got.get()
+            if item is done:
+                if err is not None:
+                    raise err
+                return
+            yield item
+    finally:
+        stop.set()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+'''
+Measure time and memory of the bib pipeline stages on a synthetic corpus.
+'''
+
+import os
+import sys
+import json
+import time
+import resource
+import tempfile
+import traceback
+import tracemalloc
+from recibi.bib import load, dump, sort, merge_patch
+
+import logging
+logger = logging.getLogger("recibi")
+warn = logger.warn
+info = logger.info
+debug = logger.debug
+
+
+stages = ("load", "merge", "sort", "dump")
+
+
+def synthetic(path, nentries, offset=0, patch=False):
+    '''
+    Write a synthetic bib file of nentries to path.
+
+    Keys are numbered from offset.  With patch, entries carry only fields
+    that merge_patch() will combine with an unpatched corpus.
+    '''
+    with open(path, "w") as out:
+        for ind in range(offset, offset + nentries):
+            if patch:
+                out.write(f'@article{{Key:{ind:08d},\n'
+                          f'    keywords = "patched,k{ind % 7}",\n'
+                          f'    note = "patch {ind}"\n}}\n\n')
+                continue
+            out.write(f'@article{{Key:{ind:08d},\n'
+                      f'    author = "Last{ind % 97}, First and Other, A.",\n'
+                      f'    title = "Synthetic title number {ind}",\n'
+                      f'    journal = "Journal {ind % 13}",\n'
+                      f'    year = "{1990 + ind % 35}",\n'
+                      f'    keywords = "k{ind % 5}"\n}}\n\n')
+
+
+def peak_rss_kb():
+    '''
+    Return the peak resident set size of this process in kB.
+    '''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak //= 1024           # bytes on macOS
+    return peak
+
+
+def child_memory(func, args, kwds, trace):
+    '''
+    Return dict of memory measurements of func run in a forked child.
+
+    A forked child starts its RSS high-water mark at its current RSS so the
+    peak is not inflated by earlier stages.  The RSS is measured before any
+    tracing which adds its own allocations.  An error in the child is raised
+    as a RuntimeError carrying the child's traceback.
+    '''
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:                # child
+        status = 1
+        try:
+            os.close(rfd)
+            with os.fdopen(wfd, "w") as fp:
+                try:
+                    start = peak_rss_kb()
+                    func(*args, **kwds)
+                    rec = dict(rss_start_kb=start, peak_rss_kb=peak_rss_kb())
+                    rec["stage_rss_kb"] = rec["peak_rss_kb"] - start
+                    if trace:
+                        tracemalloc.start()
+                        func(*args, **kwds)
+                        current, peak = tracemalloc.get_traced_memory()
+                        tracemalloc.stop()
+                        rec.update(alloc_current=current, alloc_peak=peak)
+                    status = 0
+                except BaseException:
+                    rec = dict(error=traceback.format_exc())
+                json.dump(rec, fp)
+        finally:
+            os._exit(status)
+    os.close(wfd)
+    with os.fdopen(rfd) as fp:
+        text = fp.read()
+    _, status = os.waitpid(pid, 0)
+    rec = json.loads(text) if text else dict()
+    if status or "error" in rec:
+        raise RuntimeError(f'memory measurement of {func.__name__} failed:\n'
+                           + rec.get("error", f'child exit status {status}'))
+    return rec
+
+
+def measure(name, nentries, func, *args, trace=True, **kwds):
+    '''
+    Run func(*args, **kwds) and return (result, record).
+
+    The record is a dict of the measurements of the one stage.  The timing
+    and result come from a run in this process.  Memory is measured by
+    running func again in a forked child so each stage gets its own RSS
+    peak.  Tracing allocations slows Python several-fold so with trace, the
+    child runs func a third time under tracemalloc.
+    '''
+    t0 = time.perf_counter()
+    got = func(*args, **kwds)
+    dt = time.perf_counter() - t0
+    rec = dict(stage=name, entries=nentries, seconds=dt,
+               rate=nentries / dt if dt > 0 else None)
+    rec.update(child_memory(func, args, kwds, trace))
+    debug(rec)
+    return got, rec
+
+
+def run(nentries, workdir, trace=True):
+    '''
+    Run all stages on a synthetic corpus of nentries and return records.
+
+    The corpus is a base file and a patch file overlapping half its keys.
+    '''
+    base = os.path.join(workdir, f"base-{nentries}.bib")
+    patch = os.path.join(workdir, f"patch-{nentries}.bib")
+    output = os.path.join(workdir, f"out-{nentries}.bib")
+    synthetic(base, nentries)
+    synthetic(patch, nentries, offset=nentries // 2, patch=True)
+
+    recs = list()
+    bib, rec = measure("load", nentries, load, [base], trace=trace)
+    recs.append(rec)
+    bib, rec = measure("merge", 2 * nentries, load, [base, patch],
+                       merge=merge_patch, trace=trace)
+    recs.append(rec)
+    nout = len(bib.entries)
+    bib, rec = measure("sort", nout, sort, bib, trace=trace)
+    recs.append(rec)
+    _, rec = measure("dump", nout, dump, bib, output, trace=trace)
+    recs.append(rec)
+    return recs
+
+
+def check(records, budget, max_slowdown=None):
+    '''
+    Return list of messages describing records exceeding budget.
+
+    The budget maps a stage name (or "*" for all stages) to a dict with any
+    of "max_seconds", "min_rate", "max_alloc_peak", "max_rss_kb" (the peak
+    RSS of the stage) and "max_stage_rss_kb" (its growth in RSS).
+
+    If max_slowdown is given, each stage's time per entry at its largest
+    size may be at most this factor times that at its smallest size.  This
+    catches super-linear scaling.
+    '''
+    bad = list()
+    for rec in records:
+        name = rec["stage"]
+        lim = dict(budget.get("*", {}), **budget.get(name, {}))
+        tag = f'{name} at {rec["entries"]} entries'
+        if "max_seconds" in lim and rec["seconds"] > lim["max_seconds"]:
+            bad.append(f'{tag}: {rec["seconds"]:.3f} s > {lim["max_seconds"]} s')
+        if "min_rate" in lim and rec["rate"] and rec["rate"] < lim["min_rate"]:
+            bad.append(f'{tag}: {rec["rate"]:.0f}/s < {lim["min_rate"]}/s')
+        if "max_alloc_peak" in lim and rec.get("alloc_peak", 0) > lim["max_alloc_peak"]:
+            bad.append(f'{tag}: alloc peak {rec["alloc_peak"]} B > {lim["max_alloc_peak"]} B')
+        if "max_rss_kb" in lim and rec["peak_rss_kb"] > lim["max_rss_kb"]:
+            bad.append(f'{tag}: peak RSS {rec["peak_rss_kb"]} kB > {lim["max_rss_kb"]} kB')
+        if "max_stage_rss_kb" in lim and rec["stage_rss_kb"] > lim["max_stage_rss_kb"]:
+            bad.append(f'{tag}: RSS growth {rec["stage_rss_kb"]} kB > {lim["max_stage_rss_kb"]} kB')
+
+    if max_slowdown:
+        for name in stages:
+            recs = sorted([r for r in records if r["stage"] == name],
+                          key=lambda r: r["entries"])
+            if len(recs) < 2:
+                continue
+            first, last = recs[0], recs[-1]
+            slow = (last["seconds"] / last["entries"]) / \
+                (first["seconds"] / first["entries"])
+            if slow > max_slowdown:
+                bad.append(f'{name}: time per entry grew {slow:.1f}x from '
+                           f'{first["entries"]} to {last["entries"]} entries '
+                           f'> {max_slowdown}x')
+    return bad
+
+
+def bench(sizes, budget=None, max_slowdown=None, trace=True):
+    '''
+    Run stages for each corpus size and return (records, violations).
+    '''
+    records = list()
+    with tempfile.TemporaryDirectory(prefix="recibi-bench-") as workdir:
+        for nentries in sorted(sizes):
+            info(f'bench {nentries} entries')
+            records += run(nentries, workdir, trace)
+    return records, check(records, budget or {}, max_slowdown)
+
+
+def load_budget(path):
+    '''
+    Return budget dict from a JSON file.
+    '''
+    with open(path) as fp:
+        return json.load(fp)
@@ -2,8 +2,15 @@
 
 import re
 import csv
+import bisect
 import hashlib
+import functools
+import unicodedata
+import multiprocessing
 from .util import listify
+import latexcodec
+import pybtex.errors
+from pybtex.exceptions import PybtexError
 from pybtex.database.input import bibtex
 from pybtex.database import Entry, BibliographyData, parse_string
 from dateutil.parser import parse as parse_date
@@ -76,6 +83,43 @@ def clean_entry(entry):
     return entry
 
 
+def tagger(tags, transfer=()):
+    '''
+    Return a mutate(key,entry) function adding tags to the "keywords" field.
+
+    Values of fields named in "transfer" are squashed and added as tags.  The
+    resulting keywords are unique and sorted.
+    '''
+    tags = ','.join(tags)
+
+    def squash(val):
+        return val.lower().replace(" ", "").replace("-", "")
+
+    def add_tag(key, entry):
+        old = entry.fields.get("keywords", None)
+        if not old:
+            new = tags
+        else:
+            new = old + "," + tags
+
+        # make unique and sorted
+        new = set(new.split(','))
+
+        for field in transfer:
+            val = entry.fields.get(field, None)
+            if val is None:
+                continue
+            new.add(squash(val))
+        new = list([n for n in new if n])
+        new.sort()
+        new = ','.join(new)
+        entry.fields['keywords'] = new
+
+        return (key, entry)
+
+    return add_tag
+
+
 def sort(bib):
     out = BibliographyData()
     entries = list(bib.entries.items())
@@ -86,13 +130,33 @@ def sort(bib):
     return out
 
 
-def hash_entry(entry, fields=('author','title','year','note','organization','collaboration')):
+key_fields = ('author','title','year','note','organization','collaboration')
+
+
+def entry_values(entry, fields=key_fields):
     '''
-    Return a hash of entry formed with letters.
+    Return the tuple of entry values for fields that is hashed for its key.
+
+    A missing field contributes its name.  Person fields missing from the
+    entry fields are taken from the entry persons.  Values are not
+    normalized so that keys stay those already generated and cited.
     '''
-    h = hashlib.sha1()
+    values = list()
     for field in fields:
-        string = entry.fields.get(field, field)
+        val = entry.fields.get(field, None)
+        if val is None and entry.persons.get(field):
+            val = ' and '.join(str(p) for p in entry.persons[field])
+        values.append(field if val is None else val)
+    return tuple(values)
+
+
+@functools.lru_cache(maxsize=1<<16)
+def hash_values(values):
+    '''
+    Return a hash of the tuple of strings formed with letters.
+    '''
+    h = hashlib.sha1()
+    for string in values:
         h.update(string.encode())
     d = h.digest()
     s = ""
@@ -105,13 +169,106 @@ def hash_entry(entry, fields=('author','title','year','note','organization','col
     return s
 
 
+def hash_entry(entry, fields=key_fields):
+    '''
+    Return a hash of entry formed with letters.
+    '''
+    return hash_values(entry_values(entry, fields))
+
+
+# Letters that do not decompose to ASCII under NFKD.
+ascii_letters = str.maketrans({
+    "ß": "ss", "Ł": "L", "ł": "l", "Ø": "O", "ø": "o", "Đ": "D", "đ": "d",
+    "Æ": "AE", "æ": "ae", "Œ": "OE", "œ": "oe", "ı": "i",
+})
+
+
+# Decodes TeX markup to unicode.
+ulatex = latexcodec.codec.find_latex("ulatex")
+
+
+def key_safe(name):
+    '''
+    Return name reduced to characters safe in a key: [A-Za-z0-9-].
+
+    TeX accents and markup are decoded and accented letters are replaced by
+    their base letter.
+    '''
+    try:
+        name = ulatex.decode(name)[0]
+    except ValueError:
+        pass
+    name = unicodedata.normalize("NFKD", name.translate(ascii_letters))
+    return re.sub(r'[^A-Za-z0-9-]', '', name)
+
+
+def key_name(entry):
+    '''
+    Return the name part of a generated key.
+
+    This is the last name of the first author, else of the first editor,
+    else the collaboration, else the name part of the existing key.  The
+    first of these which is not empty after key_safe() is used.
+    '''
+    names = list()
+    if 'author' in entry.fields:
+        names.append(entry.fields['author'].split(',')[0].strip().split(' ')[-1])
+    for role in ('author', 'editor'):
+        if entry.persons.get(role):
+            last = entry.persons[role][0].last_names
+            if last:
+                names.append(last[-1])
+    if entry.fields.get('collaboration'):
+        names.append(entry.fields['collaboration'].split(',')[0])
+    if entry.key:
+        names.append(entry.key.split(':')[0])
+    for name in names:
+        name = key_safe(name)
+        if name:
+            return name
+    warn(f'no name for key of entry: {entry}')
+    return 'Anonymous'
+
+
 def generate_key(entry):
-    last = entry.fields['author'].split(',')[0].strip().split(' ')[-1]
-    year = entry.fields['year']
+    last = key_name(entry)
+    year = entry.fields.get('year', '')
     rnd = hash_entry(entry)[:3]  # mimic InspireHEP
     return f'{last}:{year}{rnd}'
 
 
+def generate_keys(entries, taken=()):
+    '''
+    Return list of (key, entry) with a generated key for each entry.
+
+    Keys colliding with one in "taken" or one generated earlier in the
+    sequence are given a "-2", "-3", etc suffix so no entry is lost.
+    Suffixes depend only on the order of entries.
+    '''
+    seen = set(k.lower() for k in taken)
+    out = list()
+    for entry in entries:
+        key = base = generate_key(entry)
+        num = 1
+        while key.lower() in seen:
+            num += 1
+            key = f'{base}-{num}'
+        if num > 1:
+            info(f'duplicate key "{base}", using "{key}"')
+        seen.add(key.lower())
+        out.append((key, entry))
+    return out
+
+
+def rekey(bib):
+    '''
+    Return a new bib with generated keys for all entries of bib.
+    '''
+    out = BibliographyData()
+    out.add_entries(generate_keys(bib.entries.values()))
+    return out
+
+
 def clean_cell(col, cell):
     cell = replace_unicode(cell)
     if col == 'year':
@@ -126,7 +283,7 @@ def trans(infiles, columns, kind, delim='\t', skip=0):
     Load infiles as delim-separated values and return bibs.
     '''
     # inspired by d.jaffe's gglcsvtobibtex.py 
-    entries = dict()
+    entries = list()
     for infile in infiles:
         rows = list(csv.reader(open(infile), delimiter=delim))
         for row in rows[skip:]:
@@ -137,17 +294,75 @@ def trans(infiles, columns, kind, delim='\t', skip=0):
                 if not col:
                     continue
                 entry.fields[col] = clean_cell(col, cell)
-            key = generate_key(entry)
-            if key in entries:
-                warn(f'duplicate key "{key}", skipping: {entry}')
-                continue
-            entries[key] = entry
+            entries.append(entry)
     out = BibliographyData()
-    for key, entry in entries.items():
-        out.add_entry(key, entry)
+    out.add_entries(generate_keys(entries))
+    return out
+
+
+def mutated(key, entry, mutate=None):
+    '''
+    Return list of (key,entry) from cleaning entry and applying mutate.
+
+    See load() for "mutate".
+    '''
+    item = (key, clean_entry(entry))
+    if not mutate:
+        return [item]
+    got = mutate(*item)
+    if isinstance(got, tuple):
+        return [got]
+    if isinstance(got, list):
+        return got
+    return []
+
+
+def ingest(out, bib, mutate=None, merge=None):
+    '''
+    Add entries of bib to the out bib applying mutate and merge.
+
+    See load() for "mutate" and "merge".
+    '''
+    for inkey, inentry in bib.entries.items():
+
+        # mutate may generate
+        queue = mutated(inkey, inentry, mutate)
+
+        if not queue:
+            continue
+
+        if merge:
+            for key, entry in queue:
+                if key in out.entries:
+                    old = out.entries.pop(key)
+                    got = merge(key, old, entry)
+                    if isinstance(got, tuple):
+                        got = [got]
+                    if isinstance(got, list):
+                        for k, e in got:
+                            out.add_entry(k,e)
+                else:       # not seen, take whole
+                    out.add_entry(key, entry)
+        else:               # not merging, take all
+            out.add_entries(queue)
     return out
 
 
+def parse_text(text):
+    '''
+    Return bib object parsed from BibTeX text.
+
+    Errors such as a repeated key are warned rather than raised and the
+    first entry of a repeated key is kept.
+    '''
+    with pybtex.errors.capture() as errors:
+        # parser keeps state so make it anew for each input
+        bib = bibtex.Parser().parse_string(text)
+    for err in errors:
+        warn(pybtex.errors.format_error(err, ""))
+    return bib
+
+
 def load(bibfiles=None, mutate=None, merge=None):
     '''
     Serialize bib object from bibfile(s).
@@ -185,38 +400,7 @@ def load(bibfiles=None, mutate=None, merge=None):
         parser = bibtex.Parser()
         bib = parser.parse_file(bibfile)
 
-        for inkey, inentry in bib.entries.items():
-
-            item = (inkey, clean_entry(inentry))
-
-            # mutate may generate
-            queue = list()
-            if mutate:
-                got = mutate(*item)
-                if isinstance(got, tuple):
-                    queue.append(got)
-                elif isinstance(got, list):
-                    queue += got
-            else:
-                queue.append(item)
-            
-            if not queue:
-                continue
-
-            if merge:
-                for key, entry in queue:
-                    if key in out.entries:
-                        old = out.entries.pop(key)
-                        got = merge(key, old, entry)
-                        if isinstance(got, tuple):
-                            got = [got]
-                        if isinstance(got, list):
-                            for k, e in got:
-                                out.add_entry(k,e)
-                    else:       # not seen, take whole
-                        out.add_entry(key, entry)
-            else:               # not merging, take all
-                out.add_entries(queue)
+        ingest(out, bib, mutate, merge)
 
     return out
 
@@ -245,6 +429,138 @@ def dump(bib, output, fmt='bibtex',
     return
 
 
+def split_text(text, nchunks):
+    '''
+    Return list of about nchunks pieces of BibTeX text split before entries.
+
+    Only a line starting with "@" outside of any braces starts an entry, so a
+    field value with such a line is not split.  Text defining @string macros
+    or with entries delimited by parentheses is not split.
+    '''
+    if nchunks <= 1 or re.search(r'^[ \t]*@(string\b|\w+\s*\()',
+                                 text, re.M | re.I):
+        return [text]
+    starts = list()
+    depth = 0
+    last = 0
+    for m in re.finditer(r'^[ \t]*@', text, re.M):
+        seg = text[last:m.start()]
+        depth += seg.count('{') - seg.count('}')
+        last = m.start()
+        if depth == 0:
+            starts.append(m.start())
+    cuts = [0]
+    step = len(text) / nchunks
+    for ind in range(1, nchunks):
+        at = bisect.bisect_left(starts, int(ind * step))
+        if at < len(starts) and starts[at] > cuts[-1]:
+            cuts.append(starts[at])
+    cuts.append(len(text))
+    return [text[a:b] for a, b in zip(cuts[:-1], cuts[1:])]
+
+
+def select_text(text, match, args=(), lineno=1):
+    '''
+    Return list of (key,entry) parsed from text for which match is true.
+
+    Entries are cleaned as by load() before matching.  Parsing is strict as
+    for load().  The "lineno" of the first line of text is used in errors,
+    which are raised as a plain PybtexError so they may cross processes.
+    '''
+    try:
+        # parser keeps state so make it anew for each input
+        bib = bibtex.Parser().parse_string("\n" * (lineno - 1) + text)
+    except PybtexError as err:
+        # pybtex syntax errors can not be unpickled
+        raise PybtexError(str(err)) from None
+    out = list()
+    for inkey, inentry in bib.entries.items():
+        for key, entry in mutated(inkey, inentry):
+            if match(key, entry, *args):
+                out.append((key, entry))
+    return out
+
+
+def select(bibfiles, match, args=(), jobs=1):
+    '''
+    Return a bib of entries from bibfile(s) for which match(key,entry,*args).
+
+    See load() for "bibfiles".  If jobs is more than one, the text of each
+    file is split at entry boundaries and the pieces are parsed and matched
+    in that many worker processes which return only matching entries.  The
+    "match" function and "args" must be picklable (eg, a module level
+    function and compiled regexes).  Entry order is kept.
+    '''
+    if not bibfiles:
+        bibfiles = "-"
+    bibfiles = listify(bibfiles)
+
+    chunks = list()
+    for bibfile in bibfiles:
+        if not bibfile or bibfile == "-":
+            bibfile = "/dev/stdin"
+        with open(bibfile) as fp:
+            text = fp.read()
+        lineno = 1
+        for one in split_text(text, jobs * 4):
+            chunks.append((one, match, args, lineno))
+            lineno += one.count("\n")
+
+    if jobs > 1 and len(chunks) > 1:
+        with multiprocessing.Pool(jobs) as pool:
+            found = pool.starmap(select_text, chunks)
+    else:
+        found = [select_text(*chunk) for chunk in chunks]
+
+    out = BibliographyData()
+    for got in found:
+        out.add_entries(got)
+    return out
+
+
+def stream(bibs, output, mutate=None, merge=None,
+           header=default_header, trailer=default_trailer):
+    '''
+    Write entries from an iterable of bib objects to output as they arrive.
+
+    See load() for "mutate".  Without "merge", entries are written as each
+    bib arrives and any entry with a key already written is skipped, so
+    only the keys are held in memory.  With "merge", all entries must be
+    held to resolve duplicate keys and they are written at the end, sorted.
+
+    A empty file name or "-" is treated as stdout.
+    '''
+    if merge:
+        out = BibliographyData()
+        for bib in bibs:
+            ingest(out, bib, mutate, merge)
+        dump(sort(out), output, header=header, trailer=trailer)
+        return
+
+    if not output or output == '-':
+        output = '/dev/stdout'
+    seen = set()
+    wrote = False
+    with open(output, "w") as outfile:
+        outfile.write(header + '\n')
+        for bib in bibs:
+            out = BibliographyData()
+            for inkey, inentry in bib.entries.items():
+                for key, entry in mutated(inkey, inentry, mutate):
+                    if key.lower() in seen:
+                        debug(f'skipping repeated key "{key}"')
+                        continue
+                    seen.add(key.lower())
+                    out.add_entry(key, entry)
+            if out.entries:
+                if wrote:
+                    outfile.write('\n')
+                outfile.write(out.to_string('bibtex'))
+                outfile.flush()
+                wrote = True
+        outfile.write(trailer + '\n')
+
+
 def visit(bib, proc):
     '''
     Run proc on each entry of bib to make a new proc.
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+'''
+SQLite-backed bibliography store.
+
+Entries are kept as their BibTeX text along with a few indexed columns (year,
+doi, eprint), a per-field table for arbitrary field matching and an FTS5 table
+over title, abstract and author for full-text search.  As in BibTeX, keys
+are compared ignoring case.
+'''
+
+import re
+import sqlite3
+from pybtex.database import BibliographyData, parse_string
+
+import logging
+logger = logging.getLogger("recibi")
+warn = logger.warn
+info = logger.info
+debug = logger.debug
+
+
+schema = '''
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY COLLATE NOCASE,
+    type TEXT,
+    year INTEGER,
+    doi TEXT,
+    eprint TEXT,
+    title TEXT,
+    abstract TEXT,
+    author TEXT,
+    bibtex TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_year ON entries(year);
+CREATE INDEX IF NOT EXISTS entries_doi ON entries(doi);
+CREATE INDEX IF NOT EXISTS entries_eprint ON entries(eprint);
+
+CREATE TABLE IF NOT EXISTS fields (
+    key TEXT NOT NULL COLLATE NOCASE
+        REFERENCES entries(key) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    value TEXT
+);
+CREATE INDEX IF NOT EXISTS fields_key_name ON fields(key, name);
+CREATE INDEX IF NOT EXISTS fields_name ON fields(name, value);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS entries_fts USING fts5(
+    title, abstract, author, content='entries', content_rowid='rowid');
+
+CREATE TRIGGER IF NOT EXISTS entries_ai AFTER INSERT ON entries BEGIN
+    INSERT INTO entries_fts(rowid, title, abstract, author)
+    VALUES (new.rowid, new.title, new.abstract, new.author);
+END;
+CREATE TRIGGER IF NOT EXISTS entries_ad AFTER DELETE ON entries BEGIN
+    INSERT INTO entries_fts(entries_fts, rowid, title, abstract, author)
+    VALUES ('delete', old.rowid, old.title, old.abstract, old.author);
+END;
+'''
+
+# Person roles are not in entry.fields but are stored as fields for matching.
+person_roles = ("author", "editor")
+
+
+def regexp(pattern, value):
+    '''
+    SQL REGEXP: case insensitive re.search().
+    '''
+    if value is None:
+        return False
+    return re.search(pattern, value, re.IGNORECASE) is not None
+
+
+def rematch(pattern, value):
+    '''
+    SQL REMATCH(pattern, value): case insensitive re.match().
+    '''
+    if value is None:
+        return False
+    return re.match(pattern, value, re.IGNORECASE) is not None
+
+
+def connect(path):
+    '''
+    Return a connection to the database at path, creating schema as needed.
+    '''
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA foreign_keys = ON")
+    conn.create_function("regexp", 2, regexp)
+    conn.create_function("rematch", 2, rematch)
+    conn.executescript(schema)
+    return conn
+
+
+def persons_string(entry, role):
+    return ' and '.join(str(p) for p in entry.persons.get(role, []))
+
+
+def entry_text(key, entry):
+    '''
+    Return the BibTeX text of the entry under key.
+    '''
+    return BibliographyData(entries={key: entry}).to_string("bibtex")
+
+
+def text_entry(text):
+    '''
+    Return (key, entry) from BibTeX text of one entry.
+    '''
+    return parse_string(text, "bibtex").entries.popitem()
+
+
+def entry_row(key, entry):
+    '''
+    Return a row tuple for the entries table.
+    '''
+    year = entry.fields.get("year", "").strip()
+    year = int(year) if year.isdigit() else None
+    author = persons_string(entry, "author") or entry.fields.get("author")
+    return (key, entry.type, year,
+            entry.fields.get("doi"), entry.fields.get("eprint"),
+            entry.fields.get("title"), entry.fields.get("abstract"),
+            author, entry_text(key, entry))
+
+
+def field_rows(key, entry):
+    '''
+    Return row tuples for the fields table.
+    '''
+    rows = [(key, name.lower(), val) for name, val in entry.fields.items()]
+    for role in person_roles:
+        if role in entry.persons:
+            rows.append((key, role, persons_string(entry, role)))
+    return rows
+
+
+def put(conn, key, entry):
+    '''
+    Insert or replace one entry.
+    '''
+    conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+    conn.execute("INSERT INTO entries VALUES (?,?,?,?,?,?,?,?,?)",
+                 entry_row(key, entry))
+    conn.executemany("INSERT INTO fields VALUES (?,?,?)",
+                     field_rows(key, entry))
+
+
+def get(conn, key):
+    '''
+    Return the entry of key or None.
+    '''
+    row = conn.execute("SELECT bibtex FROM entries WHERE key = ?",
+                       (key,)).fetchone()
+    if row is None:
+        return None
+    return text_entry(row[0])[1]
+
+
+def store(conn, bib, merge=None):
+    '''
+    Store entries of bib into the database.
+
+    If "merge" is given it is called as for bib.load() when a key already
+    exists in the database, otherwise the new entry replaces the old.
+    '''
+    with conn:
+        for key, entry in bib.entries.items():
+            got = (key, entry)
+            if merge:
+                old = get(conn, key)
+                if old is not None:
+                    conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                    got = merge(key, old, entry)
+            if isinstance(got, tuple):
+                got = [got]
+            for k, e in got or ():
+                put(conn, k, e)
+
+
+def where_clause(terms=(), matches=(), numbers=(), fts=None):
+    '''
+    Return (sql, params) for a WHERE clause selecting entries.
+
+    The "terms" are (field,regex) using search semantics (key is matched at
+    the start), "matches" are (field,regex) using filter semantics, "numbers"
+    are (field,test) with test like ">=2018" and "fts" is an FTS5 MATCH query.
+    All given constraints must hold.
+    '''
+    conds = list()
+    params = list()
+
+    for field, pattern in terms:
+        if field == "key":
+            conds.append("rematch(?, e.key)")
+        else:
+            conds.append("EXISTS (SELECT 1 FROM fields f WHERE f.key = e.key"
+                         " AND f.name = lower(?) AND f.value REGEXP ?)")
+            params.append(field)
+        params.append(pattern)
+
+    for field, pattern in matches:
+        if field == "key":
+            conds.append("e.key REGEXP ?")
+        else:
+            conds.append("EXISTS (SELECT 1 FROM fields f WHERE f.key = e.key"
+                         " AND f.name = lower(?) AND f.value REGEXP ?)")
+            params.append(field)
+        params.append(pattern)
+
+    for field, test in numbers:
+        op, num = number_test(test)
+        if field == "year":
+            conds.append(f"e.year {op} ?")
+        elif field == "key":
+            conds.append(f"CAST(e.key AS REAL) {op} ?")
+        else:
+            conds.append("EXISTS (SELECT 1 FROM fields f WHERE f.key = e.key"
+                         f" AND f.name = lower(?) AND CAST(f.value AS REAL) {op} ?)")
+            params.append(field)
+        params.append(num)
+
+    if fts:
+        conds.append("e.rowid IN (SELECT rowid FROM entries_fts"
+                     " WHERE entries_fts MATCH ?)")
+        params.append(fts)
+
+    if not conds:
+        return "", ()
+    return "WHERE " + " AND ".join(conds), tuple(params)
+
+
+def number_test(test):
+    '''
+    Return (op, number) from a numerical test string like ">=2018".
+    '''
+    m = re.match(r'\s*(<=|>=|==|!=|<|>)\s*(-?\d+(?:\.\d+)?)\s*$', test)
+    if not m:
+        raise ValueError(f'unsupported numerical test: "{test}"')
+    op, num = m.groups()
+    if op == "==":
+        op = "="
+    return op, float(num)
+
+
+def select(conn, **constraints):
+    '''
+    Return bib object with entries satisfying constraints, ordered by key.
+
+    See where_clause() for constraints.
+    '''
+    where, params = where_clause(**constraints)
+    sql = f"SELECT e.bibtex FROM entries e {where} ORDER BY e.key"
+    debug(sql)
+    out = BibliographyData()
+    for (text,) in conn.execute(sql, params):
+        out.add_entry(*text_entry(text))
+    return out
+
+
+def update(conn, mutate, **constraints):
+    '''
+    Apply mutate(key,entry) to entries satisfying constraints and store.
+
+    As for bib.load(), mutate may return None (entry is deleted), a (key,
+    entry) or a list of these.  Returns number of entries visited.
+    '''
+    bib = select(conn, **constraints)
+    with conn:
+        for key, entry in bib.entries.items():
+            got = mutate(key, entry)
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            if isinstance(got, tuple):
+                got = [got]
+            for k, e in got or ():
+                put(conn, k, e)
+    return len(bib.entries)
+
+
+def select_keys(conn, keys):
+    '''
+    Return bib object with entries of the given keys, in order given.
+
+    As in BibTeX, keys are matched ignoring case and the stored key is used.
+    '''
+    out = BibliographyData()
+    for key in keys:
+        if key in out.entries:
+            continue
+        row = conn.execute("SELECT bibtex FROM entries WHERE key = ?",
+                           (key,)).fetchone()
+        if row is None:
+            warn(f'no entry with key "{key}"')
+            continue
+        out.add_entry(*text_entry(row[0]))
+    return out
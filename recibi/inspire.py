@@ -6,6 +6,8 @@ Client interface to InspireHEP web API.
 # Note, pyinspirehep exists but I can't make it do quite what I want so we just
 # DIY a barebones client.
 
+import re
+import json
 from recibi import apis
 
 api_url = 'https://inspirehep.net/api'
@@ -36,6 +38,35 @@ def form_url(identifier_type="literature", identifier_value=None, params=""):
 
     return url
 
+def count(text, format="bibtex"):
+    '''
+    Return the number of records in the text of one response.
+    '''
+    if format == "bibtex":
+        return len(re.findall(r'^\s*@\w+\s*\{', text, re.MULTILINE))
+    return len(json.loads(text).get("hits", {}).get("hits", []))
+
+
+def pages(identifier_type="literature", identifier_value=None,
+          all_pages=False, page=1, size=10, joiner=" or ", **params):
+    '''
+    Generate the text of each page of results as it is received.
+
+    Unless all_pages is true, only the given page is retrieved.  Otherwise
+    pages are retrieved until one has fewer than size records.
+    '''
+    page = int(page)
+    size = int(size)
+    while True:
+        p = form_params(joiner, page=str(page), size=str(size), **params)
+        url = form_url(identifier_type, identifier_value, p)
+        text = apis.get(url)
+        yield text
+        if not all_pages or count(text, params.get("format", "json")) < size:
+            return
+        page += 1
+
+
 # req = Request('https://inspirehep.net/api/literature?sort=mostrecent&q=arxiv:2404.01687%20or%20arxiv:2402.05383')
 # req.add_header('Accept','application/x-bibtex')
 # text = urlopen(req).read()
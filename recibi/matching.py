@@ -1,3 +1,4 @@
+import re
 
 def string_match(key, entry, matches):
     '''
@@ -39,3 +40,27 @@ def number_match(key, entry, matches):
             return False
     return True
 
+
+
+def filter_match(key, entry, matches, numbers):
+    '''
+    Match as "recibi filter": all numbers and all matches must match.
+    '''
+    return number_match(key, entry, numbers) and string_match(key, entry, matches)
+
+
+def search_match(key, entry, terms):
+    '''
+    Match as "recibi search": terms is list of (field,compiled regex).
+
+    The "key" field is matched from its start, others are searched.
+    '''
+    for field, regex in terms:
+        if field == 'key':
+            if regex.match(key):
+                continue
+        elif field in entry.fields:
+            if regex.search(entry.fields[field]):
+                continue
+        return False            # entry has no field
+    return True
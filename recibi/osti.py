@@ -1,12 +1,19 @@
 #!/usr/bin/env python
 '''
-Client interface to InspireHEP web API.
+Client interface to DOE OSTI web API.
 
 '''
 
+import re
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from recibi import apis
-from urllib.error import HTTPError
-from urllib.request import Request, urlopen
+from pybtex.database import Entry, Person
+
+import logging
+logger = logging.getLogger("recibi")
+warn = logger.warn
 
 
 api_url = 'https://www.osti.gov/api/v1'
@@ -29,9 +36,156 @@ def form_url(endpoint="records", params="", **q):
     return url
 
 
+accept = dict(bibtex='application/x-bibtex',
+              xml='application/xml',
+              json='application/json')
+
+
 def get(url, format='bibtex', **headers):
-    f2h = dict(bibtex='application/x-bibtex',
-               xml='application/xml',
-               json='application/json')
-    headers['Accept'] = f2h[format]
+    headers['Accept'] = accept[format]
     return apis.get(url, **headers)
+
+
+def pages(url, format='bibtex', **headers):
+    '''
+    Generate text of each page of results following OSTI pagination.
+    '''
+    headers['Accept'] = accept[format]
+    yield from apis.get_pages(url, **headers)
+
+
+def parse_term(term):
+    '''
+    Return (param, value) from a query term or None if unsupported.
+
+    A term is one of:
+
+        <param>=<value>
+        <idtype>:<idvalue>
+        <osti_id_number>
+        <doi>
+
+    A bare term starting like "10.1234/" is taken to be a DOI.
+    '''
+    if re.match(r'10\.\d+/', term):
+        return ('doi', term)
+    if '=' in term:
+        key, val = term.split('=', 1)
+    elif ':' in term:
+        key, val = term.split(':', 1)
+    else:
+        return ('osti_id', term)
+    key = key.lower()
+    if key == 'osti':
+        key = 'osti_id'
+    if key == 'arxiv':
+        warn(f'OSTI API does not support arXiv IDs, skipping {val}')
+        return None
+    return (key, val)
+
+
+def bulk(terms, emit, format='bibtex', jobs=4, rows=None):
+    '''
+    Retrieve all pages for each query term using a pool of jobs workers.
+
+    Each page is passed to emit(text) as soon as it arrives.  Calls to emit
+    are serialized but pages of different terms may interleave.  Returns
+    (nfail, nquery) giving the number of queries that failed, for any reason
+    including errors from emit, and the number submitted.  Terms skipped by
+    parse_term() are not counted.
+    '''
+    lock = threading.Lock()
+
+    def one(url):
+        for text in pages(url, format):
+            with lock:
+                emit(text)
+
+    urls = list()
+    for term in terms:
+        q = parse_term(term)
+        if q is None:
+            continue
+        q = dict([q])
+        if rows:
+            q['rows'] = str(rows)
+        urls.append(form_url(**q))
+
+    nfail = 0
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(one, url): url for url in urls}
+        for fut in as_completed(futures):
+            try:
+                fut.result()
+            except Exception as err:
+                warn(f'failed: {futures[fut]}: {err}')
+                nfail += 1
+    return nfail, len(urls)
+
+
+# OSTI "product_type" to BibTeX entry type.
+product_types = {
+    "journal article": "article",
+    "technical report": "techreport",
+    "thesis/dissertation": "phdthesis",
+    "conference": "inproceedings",
+    "book": "book",
+}
+
+
+def json_entry(rec):
+    '''
+    Return (key, entry) from one OSTI JSON record.
+
+    The key is formed as "OSTI:<osti_id>" so repeated retrievals of the same
+    record may be combined with bib.merge_patch().
+    '''
+    kind = product_types.get((rec.get("product_type") or "").lower(), "misc")
+    entry = Entry(kind)
+    for author in rec.get("authors") or []:
+        # authors may carry trailing "[ORCID]" or "(ORCID)" annotations
+        author = re.sub(r'\s*[\[(].*$', '', author).strip()
+        if author:
+            entry.add_person(Person(author), "author")
+    fields = dict(title=rec.get("title"),
+                  doi=rec.get("doi"),
+                  journal=rec.get("journal_name"),
+                  volume=rec.get("journal_volume"),
+                  number=rec.get("journal_issue"),
+                  publisher=rec.get("publisher"),
+                  institution=rec.get("research_orgs"),
+                  reportNumber=rec.get("report_number"),
+                  abstract=rec.get("description"),
+                  url=rec.get("doi") and f'https://doi.org/{rec["doi"]}')
+    date = rec.get("publication_date")
+    if date:
+        fields["year"] = date[:4]
+    for name, val in fields.items():
+        if isinstance(val, list):
+            val = "; ".join(val)
+        if val:
+            entry.fields[name] = val
+    entry.key = f'OSTI:{rec["osti_id"]}'
+    return (entry.key, entry)
+
+
+def json_entries(text):
+    '''
+    Return list of (key, entry) from an OSTI JSON records response.
+
+    See json_entry().  Records with no osti_id or which fail to convert are
+    skipped with a warning.
+    '''
+    records = json.loads(text)
+    if isinstance(records, dict):
+        records = [records]
+    out = list()
+    for rec in records:
+        if not rec.get("osti_id"):
+            warn(f'skipping OSTI record with no osti_id: {rec.get("title")}')
+            continue
+        try:
+            out.append(json_entry(rec))
+        except Exception as err:
+            warn(f'skipping OSTI record {rec["osti_id"]}: {err}')
+    return out
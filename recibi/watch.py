@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+'''
+Incrementally rebuild derived bibliographies when their inputs change.
+
+A rule file is JSON like:
+
+    {"rules": [
+        {"output": "dune.bib",
+         "inputs": ["generated.bib", "curated.bib"],
+         "match": ["collaboration:dune"],
+         "number": ["year:>2018"],
+         "search": ["title=neutrino"],
+         "tag": ["dune"],
+         "transfer": ["collaboration"]}
+    ]}
+
+Each rule loads its inputs in order, merges entries with repeated keys with
+merge_patch() (as "recibi merge"), keeps merged entries passing "match" and
+"number" (as "recibi filter") and "search" (as "recibi search") and adds
+"tag" and "transfer" keywords (as "recibi tag").  The output is sorted by
+key.
+
+Inputs are polled for modification.  A changed input is parsed and compared
+entry by entry with its previous content so only added, changed and removed
+entries are passed through the rule again.
+'''
+
+import os
+import re
+import json
+import time
+import tempfile
+from pybtex.database import BibliographyData
+from pybtex.database.input import bibtex
+from recibi.bib import (
+    copy_entry, merge_patch, tagger, mutated, default_header, default_trailer)
+from recibi.matching import filter_match, search_match
+
+import logging
+logger = logging.getLogger("recibi")
+warn = logger.warn
+info = logger.info
+debug = logger.debug
+
+
+def render(key, entry):
+    '''
+    Return BibTeX text of one entry.
+    '''
+    return BibliographyData(entries={key: entry}).to_string("bibtex")
+
+
+def write_atomic(path, text):
+    '''
+    Write text to path by replacing it with a completed temporary file.
+    '''
+    dirname = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix=".recibi-")
+    try:
+        with os.fdopen(fd, "w") as fp:
+            fp.write(text)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def parse_file(path):
+    '''
+    Return dict from key to entry parsed from file at path.
+    '''
+    return dict(bibtex.Parser().parse_file(path).entries.items())
+
+
+def diff(old, new):
+    '''
+    Return set of keys added, changed or removed between two entry dicts.
+    '''
+    keys = set(old).symmetric_difference(new)
+    for key in set(old).intersection(new):
+        if old[key] != new[key]:
+            keys.add(key)
+    return keys
+
+
+class Rule:
+    '''
+    One output bibliography derived from its inputs.
+
+    Per input the rule keeps the entries as last parsed, by lower case key.
+    Entries of a key are merged across inputs before the filter and tag
+    steps, as with "recibi merge" followed by "recibi filter" and "recibi
+    tag", so a patch entry lacking a filtered field still reaches the
+    output.  Per output key it keeps the text of the resulting entry.
+    '''
+
+    def __init__(self, output, inputs, match=(), number=(), search=(),
+                 tag=(), transfer=()):
+        self.output = output
+        self.inputs = list(inputs)
+        self.matches = tuple(m.split(":", 1) for m in match)
+        self.numbers = tuple(n.split(":", 1) for n in number)
+        self.terms = tuple((f, re.compile(r, re.IGNORECASE))
+                           for f, r in (s.split("=", 1) for s in search))
+        self.tagit = tagger(tag, transfer) if tag or transfer else None
+
+        self.raw = {path: dict() for path in self.inputs}
+        self.outs = dict()
+        self.texts = dict()
+        self.written = False
+
+    def mutate(self, key, entry):
+        if not filter_match(key, entry, self.matches, self.numbers):
+            return
+        if not search_match(key, entry, self.terms):
+            return
+        if self.tagit:
+            return self.tagit(key, entry)
+        return (key, entry)
+
+    def update(self, path, entries):
+        '''
+        Apply the new entries of input path and return affected output keys.
+        '''
+        entries = {key.lower(): (key, entry) for key, entry in entries.items()}
+        keys = diff(self.raw[path], entries)
+        self.raw[path] = entries
+        affected = set()
+        for key in keys:
+            affected.update(self.remerge(key))
+        return affected
+
+    def remerge(self, lkey):
+        '''
+        Recompute the output of the lower case input key from all inputs.
+
+        Entries are merged in input order then filtered and tagged.  Returns
+        the output keys removed or written.
+        '''
+        merged = None
+        for path in self.inputs:
+            got = self.raw[path].get(lkey)
+            if got is None:
+                continue
+            key, entry = got
+            if merged is None:
+                # mutation is in-place so keep the parsed entry pristine
+                merged = copy_entry(entry)
+            else:
+                merged = merge_patch(key, merged, entry)[1]
+        affected = set(self.outs.pop(lkey, ()))
+        for k in affected:
+            self.texts.pop(k, None)
+        if merged is None:
+            return affected
+        got = mutated(key, merged, self.mutate)
+        self.outs[lkey] = [k for k, _ in got]
+        for k, entry in got:
+            self.texts[k] = render(k, entry)
+            affected.add(k)
+        return affected
+
+    def write(self):
+        '''
+        Atomically write the output bibliography.
+        '''
+        body = '\n'.join(self.texts[key] for key in sorted(self.texts))
+        write_atomic(self.output,
+                     default_header + '\n' + body + default_trailer + '\n')
+        self.written = True
+
+
+def load_rules(path):
+    '''
+    Return list of Rule objects from a JSON rule file.
+
+    Relative paths in rules are relative to the directory of the rule file.
+    '''
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path) as fp:
+        cfg = json.load(fp)
+    rules = list()
+    for one in cfg["rules"]:
+        one = dict(one)
+        one["output"] = os.path.join(base, one["output"])
+        one["inputs"] = [os.path.join(base, p) for p in one["inputs"]]
+        rules.append(Rule(**one))
+    return rules
+
+
+def mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def step(rules, mtimes, strict=False):
+    '''
+    Process inputs changed since mtimes and return list of outputs written.
+
+    The mtimes dict is updated.  Rules are processed in order so an output
+    used as an input to a later rule is picked up in the same step.
+
+    An input which fails to parse is raised if strict.  Otherwise it is
+    warned, its previous entries are kept and it is not parsed again until
+    its next change.
+    '''
+    written = list()
+    parsed = dict()
+    for rule in rules:
+        affected = set()
+        for path in rule.inputs:
+            now = mtime(path)
+            if path not in parsed and now == mtimes.get(path, False):
+                continue
+            if path not in parsed:
+                mtimes[path] = now
+                try:
+                    parsed[path] = parse_file(path) if now is not None else {}
+                except Exception as err:
+                    if strict:
+                        raise
+                    warn(f'{path}: {err}, waiting for next change')
+                    parsed[path] = None
+            if parsed[path] is None:
+                continue
+            got = rule.update(path, parsed[path])
+            if got:
+                debug(f'{path}: {len(got)} entries affect {rule.output}')
+            affected.update(got)
+        # always write on the first step to replace any stale output
+        if affected or not rule.written:
+            rule.write()
+            mtimes.pop(rule.output, None)
+            written.append(rule.output)
+            info(f'wrote {rule.output}, {len(affected)} entries updated')
+    return written
+
+
+def watch(rules, interval=0.5, once=False):
+    '''
+    Build outputs of rules then rebuild as inputs change.
+
+    With once, build outputs and return.
+    '''
+    mtimes = dict()
+    if once:
+        step(rules, mtimes, strict=True)
+        return
+    while True:
+        try:
+            step(rules, mtimes)
+        except Exception as err:
+            warn(f'rebuild failed: {err}')
+        time.sleep(interval)